@@ -1,15 +1,28 @@
-from flask import Flask, jsonify, request, render_template, url_for, redirect, flash, get_flashed_messages, session as flask_session
+import os
+from flask import Flask, jsonify, request, make_response, render_template, url_for, redirect, flash, get_flashed_messages, session as flask_session
 from flask_wtf.csrf import CSRFProtect
+from datetime import datetime
+from sqlalchemy import func
 from sqlalchemy.orm import joinedload
 from extenstions import LoginManager, current_user, login_user
 from database import get_session
-from objects import Customer, Order, Product, OrderItem
+from objects import Customer, Order, Product, OrderItem, ArchivedOrder, ArchivedOrderItem, CustomerSummary
 from forms import CustomerForm, ProductForm, OrderForm, OrderItemForm, LoginForm
+from customer_stats import record_order, get_summary, rebuild_summaries
+from idempotency import idempotent, purge_expired_keys, start_key_purger
+from catalog import bulk_update_products, bump_catalog_version, current_catalog_version, record_price_change, get_prices, BulkUpdateError
+from archive import (archive_orders, start_archiver, get_archived_order, get_archived_order_items,
+                     get_archived_customer_orders, ARCHIVE_AFTER_DAYS, ARCHIVE_BATCH_SIZE)
+from purge import purge_deleted, compact, enable_incremental_vacuum, start_purger, PURGE_RETENTION_DAYS, PURGE_BATCH_SIZE
 
 app = Flask(__name__)
 app.config["SECRET_KEY"] = "Slighting-Speckled9-Hypnotist-Tranquil-Marital"
 csrf = CSRFProtect(app)
 login = LoginManager(app)
+app.config["ORDER_ARCHIVE_AFTER_DAYS"] = ARCHIVE_AFTER_DAYS
+app.config["ORDER_ARCHIVE_BATCH_SIZE"] = ARCHIVE_BATCH_SIZE
+app.config["DELETED_RETENTION_DAYS"] = PURGE_RETENTION_DAYS
+app.config["DELETED_PURGE_BATCH_SIZE"] = PURGE_BATCH_SIZE
 
 # Helper function to serialise SQLAlchemy objects
 def serialise(obj):
@@ -19,7 +32,7 @@ def serialise(obj):
             "name" : obj.name,
             "email" : obj.email
         }
-    elif isinstance(obj, Order):
+    elif isinstance(obj, (Order, ArchivedOrder)):
         return {
             "id" : obj.id,
             "customer_id" : obj.customer_id,
@@ -31,12 +44,13 @@ def serialise(obj):
             "name" : obj.name,
             "price" : obj.price
         }
-    elif isinstance(obj, OrderItem):
+    elif isinstance(obj, (OrderItem, ArchivedOrderItem)):
         return {
             "id" : obj.id,
             "order_id" : obj.order_id,
             "product_id" : obj.product_id,
-            "quantity" : obj.quantity
+            "quantity" : obj.quantity,
+            "unit_price" : obj.unit_price
         }
     return {}
 
@@ -51,7 +65,7 @@ def login():
         return redirect(url_for('index'))
     form = LoginForm()
     if form.validate_on_submit():
-        with get_session() as session:
+        with get_session(write=False) as session:
             customer = session.query(Customer).where(Customer.email == form.email.data)
             if customer is None or not customer.check_password(form.password.data):
                 flash('Invalid username or password')
@@ -79,26 +93,37 @@ def add_new_customer():
 # Routes for customers
 @app.route("/customers", methods=["GET"])
 def get_customers():
-    with get_session() as session:
+    with get_session(write=False) as session:
         # Eager load the orders relationship so html can access it
         # Only get active customers
-        customers = session.query(Customer).filter(Customer.active == True).all()
+        # Totals come from the summary table rather than the order history
+        order_count = func.coalesce(CustomerSummary.order_count, 0)
+        lifetime_value = func.coalesce(CustomerSummary.lifetime_value, 0)
+        query = (session.query(Customer, order_count, lifetime_value)
+                 .outerjoin(CustomerSummary, CustomerSummary.customer_id == Customer.id)
+                 .filter(Customer.active == True))
+        # Top customers first
+        if request.args.get("sort") == "ltv":
+            query = query.order_by(lifetime_value.desc(), Customer.id)
+        rows = query.all()
+        customers = [customer for customer, _, _ in rows]
     
         # differentiate between .json and html requests
         if request.args.get("format") == "json" or request.headers.get("Accept") == "application/json":
-            return jsonify([serialise(customer) for customer in customers])
+            return jsonify([{**serialise(customer), "order_count" : orders, "lifetime_value" : value}
+                            for customer, orders, value in rows])
         else:
             return render_template("customers.html", title="Customers - ", customers=customers)
     
 
 @app.route("/customers/<int:customer_id>", methods=["GET"])
 def get_customer(customer_id):
-    with get_session() as session:
+    with get_session(write=False) as session:
         customer = session.query(Customer).get(customer_id)
-        session.close()
-
         if customer:
-            return jsonify(serialise(customer))
+            customer_data = serialise(customer)
+            customer_data["summary"] = get_summary(session, customer_id)
+            return jsonify(customer_data)
     return jsonify({"error": "Customer not found"}), 404
 
 # Edit customers
@@ -109,7 +134,7 @@ def edit_customer(customer_id):
 
     # Handle GET request + populate form
     if request.method == "GET":
-        with get_session() as session:
+        with get_session(write=False) as session:
             customer = session.query(Customer).get(customer_id)
             if not customer:
                 flash("Customer not found", "error")
@@ -144,12 +169,13 @@ def edit_customer(customer_id):
     return render_template("edit_customer.html", form=form, name=customer_name or form.name.data, id=customer_id) # Edit html to use customer var only?
 
 @app.route('/customers', methods=['POST'])
+@idempotent
 def create_customer():
     data = request.json
     with get_session() as session:
         customer = Customer(name=data['name'], email=data['email'])
         session.add(customer)
-        session.commit()
+        session.flush()
         customer_data = serialise(customer)
     return jsonify(customer_data), 201
 
@@ -164,6 +190,7 @@ def delete_customer(customer_id):
         
         # Soft delete - just mark as inacticve
         customer.active = False
+        customer.deleted_at = datetime.utcnow()
 
         flash(f"Customer {customer.name} has been deleted", "success")
         return redirect(url_for("get_customers")) 
@@ -171,7 +198,7 @@ def delete_customer(customer_id):
 # View deleted customers
 @app.route("/customers/deleted", methods=["GET"])
 def get_deleted_customers():
-    with get_session() as session:
+    with get_session(write=False) as session:
         deleted_customers = session.query(Customer).filter(Customer.active == False).all()
         return render_template("deleted_customers.html", title="Deleted Customers", customers=deleted_customers)
 
@@ -185,6 +212,7 @@ def restore_customer(customer_id):
             return redirect(url_for("get_customers"))
         
         customer.active = True
+        customer.deleted_at = None
 
         flash(f"Customer {customer.name} has been restored successfully", "success")
         return redirect(url_for("get_customers"))
@@ -192,9 +220,10 @@ def restore_customer(customer_id):
 # View customer orders
 @app.route("/customers/<int:customer_id>/orders", methods=["GET"])
 def get_customer_orders(customer_id):
-    with get_session() as session:
+    with get_session(write=False) as session:
         customer_orders = session.query(Order).filter(Order.customer_id == customer_id).options(joinedload(Order.customer)).all()
-        session.close()
+        # Older orders may have been moved to the archive tables
+        customer_orders += get_archived_customer_orders(session, customer_id)
 
         if customer_orders:
             for order in customer_orders:
@@ -204,39 +233,76 @@ def get_customer_orders(customer_id):
             return 404
 
 # Routes for products
+def catalog_etag(catalog_version):
+    return f"catalog-{catalog_version}"
+
+def not_modified(etag):
+    '''Returns a 304 response if the client already has etag, else None'''
+    if request.if_none_match.contains(etag):
+        response = make_response("", 304)
+        response.set_etag(etag)
+        return response
+    return None
+
 @app.route("/products", methods=["GET"])
 def get_products():
-    with get_session() as session:
+    wants_json = request.args.get("format") == "json" or request.headers.get("Accept") == "application/json"
+    with get_session(write=False) as session:
+        catalog_version = current_catalog_version(session)
+        # The catalog version changes with every product change, so it can stand in for the listing
+        if wants_json and (cached := not_modified(catalog_etag(catalog_version))):
+            return cached
+
         products = session.query(Product).filter(Product.active==True).all()
         products_data = [serialise(product) for product in products]
-        session.close()
 
-    if request.args.get("format") == "json" or request.headers.get("Accept") == "application/json":
-        return jsonify(products_data)
+    if wants_json:
+        response = jsonify(products_data)
+        response.set_etag(catalog_etag(catalog_version))
+        return response
     else:
         return render_template("products.html", title="Products - ", products=products)
 
 @app.route("/products/<int:product_id>", methods=["GET"])
 def get_product(product_id):
-    with get_session() as session:
+    with get_session(write=False) as session:
         product = session.query(Product).get(product_id)
-        session.close()
 
         if product:
-            return jsonify(serialise(product))
+            # Only products that exist can be "not modified", a missing id is always a 404
+            catalog_version = current_catalog_version(session)
+            if cached := not_modified(catalog_etag(catalog_version)):
+                return cached
+            response = jsonify(serialise(product))
+            response.set_etag(catalog_etag(catalog_version))
+            return response
     return jsonify({"error" : "Product not found"}), 404
 
 @app.route("/products", methods=["POST"])
+@idempotent
 def create_product():
     data = request.json
     with get_session() as session:
         product = Product(name=data["name"], price=data["price"])
         session.add(product)
-        session.commit()
+        bump_catalog_version(session)
+        session.flush()
         product_data = serialise(product)
-        #session.close()
     return jsonify(product_data), 201
 
+# Bulk update products
+@app.route("/products/bulk", methods=["PATCH"])
+@idempotent
+def bulk_update_products_route():
+    '''Applies {"products": [{"id": 1, "price": 9.99, "active": true}, ...]} in one transaction'''
+    data = request.json or {}
+    try:
+        with get_session() as session:
+            result = bulk_update_products(session, data.get("products"))
+    except BulkUpdateError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(result)
+
 # Add product via HTML
 @app.route("/products/add", methods=["GET", "POST"])
 def create_new_product():
@@ -248,6 +314,7 @@ def create_new_product():
                 product = Product(name=form.name.data,
                                 price=form.price.data)
                 session.add(product)
+                bump_catalog_version(session)
             flash("Product added successfully", "success")
             return redirect(url_for("get_products"))
         
@@ -263,7 +330,7 @@ def edit_product(product_id):
 
     # Load page - GET request
     if request.method == "GET":
-        with get_session() as session:
+        with get_session(write=False) as session:
             product = session.query(Product).get(product_id)
             if not product:
                 flash("Product not found", "error")
@@ -282,6 +349,8 @@ def edit_product(product_id):
                     flash("Product not found", "error")
                     return redirect(url_for("products"))
                 
+                version = bump_catalog_version(session)
+                record_price_change(session, product, form.price.data, version)
                 product.name = form.name.data
                 product.price = form.price.data
 
@@ -304,6 +373,8 @@ def delete_product(product_id):
             return redirect(url_for("get_products"))
         
         product.active = False
+        product.deleted_at = datetime.utcnow()
+        bump_catalog_version(session)
         flash(f"Product '{product.name}' has been deleted", "success")
 
         return redirect(url_for("get_products"))
@@ -311,7 +382,7 @@ def delete_product(product_id):
 # View deleted products
 @app.route("/products/deleted", methods=["GET"])
 def get_deleted_products():
-    with get_session() as session:
+    with get_session(write=False) as session:
         products = session.query(Product).filter(Product.active == False).all()
         return render_template("deleted_products.html", title="Deleted Products", products=products) 
 
@@ -325,14 +396,16 @@ def restore_product(product_id):
             return redirect(url_for("get_products"))
         
         product.active = True
+        product.deleted_at = None
+        bump_catalog_version(session)
         flash(f"Product '{product.name}' successfully restored", "success")
         return redirect(url_for("get_products"))
     
 # View product orders
 @app.route("/products/<int:product_id>/orders", methods=["GET"])
 def get_product_orders(product_id):
-    with get_session() as session:
-        orders = session.query(Order).filter(Order.items.product_id == product_id).options(joinedload(Order.items)).all()
+    with get_session(write=False) as session:
+        orders = session.query(Order).filter(Order.items.any(OrderItem.product_id == product_id)).options(joinedload(Order.items)).all()
         if not orders:
             flash("No orders associated with this product", "error")
             return redirect(url_for("get_products"))
@@ -343,10 +416,9 @@ def get_product_orders(product_id):
 # Get all orders
 @app.route("/orders", methods=["GET"])
 def get_orders():
-    with get_session() as session:
+    with get_session(write=False) as session:
         orders = session.query(Order).options(joinedload(Order.customer)).options(joinedload(Order.items)).all()
         orders_data = [serialise(order) for order in orders]
-        session.close()
 
     if request.args.get("format") == "json" or request.headers.get("Accept") == "application/json":
         return jsonify(orders_data)
@@ -356,31 +428,38 @@ def get_orders():
 # Get one order
 @app.route("/orders/<int:order_id>", methods=["GET"])
 def get_order(order_id):
-    with get_session() as session:
-        order = session.query(Order).get(order_id)
-        session.close()
+    with get_session(write=False) as session:
+        order = session.query(Order).get(order_id) or get_archived_order(session, order_id)
+        # Serialise while the session is open so the items can still be loaded
+        order_data = serialise(order) if order else None
 
-        if order:
-            return jsonify(serialise(order))
+    if order_data:
+        return jsonify(order_data)
     return jsonify({"error" : "Unable to find order"}), 404
 
 # Create new order
 @app.route("/orders", methods=["POST"])
+@idempotent
 def create_order():
     data = request.json
     with get_session() as session:
         order = Order(customer_id=data["customer_id"])
         session.add(order)
-        session.commit() # Add order so we can access order.id
+        session.flush() # Add order so we can access order.id
 
         # Add order items
+        prices = get_prices(session, [item["product_id"] for item in data["items"]])
         for item in data["items"]:
             order_item = OrderItem(
                 order_id = order.id,
                 product_id=item["product_id"], 
-                quantity=item["quantity"])
+                quantity=item["quantity"],
+                unit_price=prices.get(item["product_id"]))
             session.add(order_item)
-        session.commit()
+        record_order(session, order.customer_id,
+                     [(item["product_id"], item["quantity"], prices.get(item["product_id"])) for item in data["items"]],
+                     order.created_at)
+        session.flush()
 
         order_data = {
             "id" : order.id,
@@ -397,7 +476,7 @@ def create_order():
 @app.route("/orders/<int:customer_id>/add_order", methods =["GET", "POST"])
 def add_order(customer_id):
     # Verify customer exists
-    with get_session() as session:
+    with get_session(write=False) as session:
         customer = session.query(Customer).get(customer_id)
         if not customer:
             flash("Customer not found", "error")
@@ -419,7 +498,7 @@ def add_order(customer_id):
     # Handle adding an item to the order
     if request.method == "POST" and "add_item" in request.form:
         if item_form.validate_on_submit():
-            with get_session() as session:
+            with get_session(write=False) as session:
                 product = session.query(Product).get(item_form.product_id.data)
 
                 flask_session["order_items"].append({
@@ -452,15 +531,18 @@ def add_order(customer_id):
                 session.flush() # makes new order ID available
 
                 # Add order items
+                prices = get_prices(session, [item["product_id"] for item in flask_session["order_items"]])
                 for item in flask_session["order_items"]:
                     order_item = OrderItem(
                         order_id=new_order.id,
                         product_id=item["product_id"],
-                        quantity=item["quantity"]
+                        quantity=item["quantity"],
+                        unit_price=prices.get(item["product_id"])
                     )
                     session.add(order_item)
-
-                session.commit()
+                record_order(session, customer_id,
+                             [(item["product_id"], item["quantity"], prices.get(item["product_id"])) for item in flask_session["order_items"]],
+                             new_order.created_at)
 
                 # Clear Flask session order items
                 flask_session.pop("order_items", None)
@@ -488,11 +570,13 @@ def add_order(customer_id):
 @app.route("/orders/view/<int:order_id>", methods=["GET"])
 def view_order(order_id):
     # Query order
-    with get_session() as session:
+    with get_session(write=False) as session:
         order_items = (session.query(OrderItem)
                        .options(joinedload(OrderItem.product))
                        .filter_by(order_id=order_id)
                        .all())
+        if not order_items:
+            order_items = get_archived_order_items(session, order_id)
         
         if not order_items:
             flash("Order does not exist", "error")
@@ -508,6 +592,52 @@ def view_order(order_id):
 
         return render_template("view_order.html", title=f"Order #{order_id}", items=order_items)
 
+@app.cli.command("archive-orders")
+def archive_orders_command():
+    '''Moves orders older than ORDER_ARCHIVE_AFTER_DAYS into the archive tables'''
+    moved = archive_orders(app.config["ORDER_ARCHIVE_AFTER_DAYS"], app.config["ORDER_ARCHIVE_BATCH_SIZE"])
+    print(f"Archived {moved} order(s)")
+
+@app.cli.command("purge-idempotency-keys")
+def purge_idempotency_keys_command():
+    '''Deletes stored Idempotency-Key responses past their TTL'''
+    purged = purge_expired_keys()
+    print(f"Purged {purged} idempotency key(s)")
+
+@app.cli.command("rebuild-customer-summaries")
+def rebuild_customer_summaries_command():
+    '''Recomputes every customer's order count, lifetime value and favourite products'''
+    rebuilt = rebuild_summaries()
+    print(f"Rebuilt {rebuilt} customer summaries")
+
+@app.cli.command("purge-deleted")
+def purge_deleted_command():
+    '''Hard deletes customers and products soft deleted more than DELETED_RETENTION_DAYS ago, then compacts the database'''
+    purged = purge_deleted(app.config["DELETED_RETENTION_DAYS"], app.config["DELETED_PURGE_BATCH_SIZE"])
+    print(f"Purged {purged['customers']} customer(s) and {purged['products']} product(s)")
+    freed = compact()
+    if freed is None:
+        print("Incremental vacuum is off, run enable-incremental-vacuum once to let purges shrink the file")
+    else:
+        print(f"Freed {freed} page(s)")
+
+@app.cli.command("enable-incremental-vacuum")
+def enable_incremental_vacuum_command():
+    '''One-off VACUUM that lets purge-deleted return free space to the filesystem'''
+    enable_incremental_vacuum()
+    print("Incremental vacuum enabled")
+
+def start_background_jobs():
+    '''Starts the order archiver, the deleted row purger and the idempotency key purger on daemon threads'''
+    start_archiver(older_than_days=app.config["ORDER_ARCHIVE_AFTER_DAYS"],
+                   batch_size=app.config["ORDER_ARCHIVE_BATCH_SIZE"])
+    start_purger(retention_days=app.config["DELETED_RETENTION_DAYS"],
+                 batch_size=app.config["DELETED_PURGE_BATCH_SIZE"])
+    start_key_purger()
+
 # Run the flask app
 if __name__ == "__main__":
+    # The debug reloader imports the app twice, only run background jobs in the serving process
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_background_jobs()
     app.run(debug=True)
\ No newline at end of file
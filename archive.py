@@ -0,0 +1,92 @@
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import select, insert, delete, literal
+from sqlalchemy.orm import joinedload
+from database import get_session
+from objects import Order, OrderItem, ArchivedOrder, ArchivedOrderItem
+
+# Orders older than this are moved out of the hot tables
+ARCHIVE_AFTER_DAYS = 365
+# Orders moved per transaction, keeps each write lock short
+ARCHIVE_BATCH_SIZE = 500
+
+def archive_batch(session, cutoff, batch_size=ARCHIVE_BATCH_SIZE):
+    '''Moves up to batch_size orders created before cutoff (and their items) into the archive tables.
+    Returns the number of orders moved'''
+    # orders and order_items use AUTOINCREMENT, so the ids copied here are never handed out again
+    order_ids = session.execute(
+        select(Order.id)
+        .where(Order.created_at < cutoff)
+        .order_by(Order.id)
+        .limit(batch_size)
+    ).scalars().all()
+    if not order_ids:
+        return 0
+
+    session.execute(insert(ArchivedOrder).from_select(
+        ["id", "customer_id", "created_at", "archived_at"],
+        select(Order.id, Order.customer_id, Order.created_at, literal(datetime.utcnow()))
+        .where(Order.id.in_(order_ids))
+    ))
+    session.execute(insert(ArchivedOrderItem).from_select(
+        ["id", "order_id", "product_id", "quantity", "unit_price"],
+        select(OrderItem.id, OrderItem.order_id, OrderItem.product_id, OrderItem.quantity, OrderItem.unit_price)
+        .where(OrderItem.order_id.in_(order_ids))
+    ))
+    session.execute(delete(OrderItem).where(OrderItem.order_id.in_(order_ids)))
+    session.execute(delete(Order).where(Order.id.in_(order_ids)))
+    return len(order_ids)
+
+def archive_orders(older_than_days=ARCHIVE_AFTER_DAYS, batch_size=ARCHIVE_BATCH_SIZE, pause=0.0):
+    '''Archives every order older than older_than_days, one batch per transaction.
+    pause (seconds) is slept between batches to give other writers a turn'''
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    total = 0
+    while True:
+        with get_session() as session:
+            moved = archive_batch(session, cutoff, batch_size)
+        total += moved
+        if moved < batch_size:
+            return total
+        if pause:
+            time.sleep(pause)
+
+def start_archiver(interval=3600, older_than_days=ARCHIVE_AFTER_DAYS, batch_size=ARCHIVE_BATCH_SIZE, pause=0.1):
+    '''Runs archive_orders every interval seconds on a daemon thread'''
+    def run():
+        while True:
+            try:
+                moved = archive_orders(older_than_days, batch_size, pause)
+                if moved:
+                    print(f"Archived {moved} order(s)")
+            except Exception as e:
+                print(f"Order archiving failed: {e}")
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, name="order-archiver", daemon=True)
+    thread.start()
+    return thread
+
+# Read-through helpers, used when an id is no longer in the hot tables
+
+def get_archived_order(session, order_id):
+    '''Returns the ArchivedOrder with its items loaded, or None'''
+    return (session.query(ArchivedOrder)
+            .options(joinedload(ArchivedOrder.items))
+            .filter_by(id=order_id)
+            .first())
+
+def get_archived_order_items(session, order_id):
+    '''Returns the archived items of an order with their products loaded'''
+    return (session.query(ArchivedOrderItem)
+            .options(joinedload(ArchivedOrderItem.product))
+            .filter_by(order_id=order_id)
+            .all())
+
+def get_archived_customer_orders(session, customer_id):
+    '''Returns every archived order for a customer'''
+    return (session.query(ArchivedOrder)
+            .filter(ArchivedOrder.customer_id == customer_id)
+            .options(joinedload(ArchivedOrder.customer))
+            .all())
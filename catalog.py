@@ -0,0 +1,111 @@
+from datetime import datetime
+from sqlalchemy import Table, Column, Integer, Float, Boolean, DateTime, MetaData, select, insert, update, func, literal, case
+from objects import Product, CatalogVersion, ProductPriceHistory
+
+# Per-connection scratch table the bulk changes are loaded into, so the
+# products table is updated with one joined UPDATE instead of a query per row
+_product_updates = Table(
+    "product_updates", MetaData(),
+    Column("id", Integer, primary_key=True),
+    Column("price", Float, nullable=True),
+    Column("active", Boolean, nullable=True),
+    prefixes=["TEMPORARY"],
+)
+
+class BulkUpdateError(ValueError):
+    pass
+
+def current_catalog_version(session):
+    '''Returns the latest catalog version number, 0 before any product has changed'''
+    return session.execute(select(func.max(CatalogVersion.id))).scalar() or 0
+
+def bump_catalog_version(session, products_changed=1):
+    '''Records a new catalog version and returns its number'''
+    version = CatalogVersion(created_at=datetime.utcnow(), products_changed=products_changed)
+    session.add(version)
+    session.flush()
+    return version.id
+
+def get_prices(session, product_ids):
+    '''Returns {product_id: current price} for the given products'''
+    return dict(session.execute(
+        select(Product.id, Product.price).where(Product.id.in_(set(product_ids)))
+    ).all())
+
+def record_price_change(session, product, new_price, version):
+    '''Adds a price history row if new_price differs from the product's current price'''
+    if product.price != new_price:
+        session.add(ProductPriceHistory(product_id=product.id,
+                                        catalog_version=version,
+                                        old_price=product.price,
+                                        new_price=new_price,
+                                        changed_at=datetime.utcnow()))
+
+def _parse_changes(changes):
+    if not isinstance(changes, list) or not changes:
+        raise BulkUpdateError("Expected a non-empty list of product changes")
+
+    rows = {}
+    for change in changes:
+        if not isinstance(change, dict) or not isinstance(change.get("id"), int):
+            raise BulkUpdateError("Each change needs an integer 'id'")
+        price = change.get("price")
+        active = change.get("active")
+        if price is None and active is None:
+            raise BulkUpdateError(f"Product {change['id']}: nothing to change, give 'price' and/or 'active'")
+        if price is not None and (isinstance(price, bool) or not isinstance(price, (int, float)) or price < 0):
+            raise BulkUpdateError(f"Product {change['id']}: 'price' must be a non-negative number")
+        if active is not None and not isinstance(active, bool):
+            raise BulkUpdateError(f"Product {change['id']}: 'active' must be true or false")
+        # Last change for an id wins
+        rows[change["id"]] = {"id": change["id"], "price": price, "active": active}
+    return list(rows.values())
+
+def bulk_update_products(session, changes):
+    '''Applies price/active changes to many products in one set-based UPDATE.
+    changes is a list of {"id": .., "price": .., "active": ..} dicts, price and active optional.
+    Records price history and a new catalog version, returns a summary dict'''
+    rows = _parse_changes(changes)
+
+    connection = session.connection()
+    _product_updates.create(connection, checkfirst=True)
+    connection.execute(_product_updates.delete())
+    connection.execute(insert(_product_updates), rows)
+
+    not_found = connection.execute(
+        select(_product_updates.c.id)
+        .where(_product_updates.c.id.not_in(select(Product.id)))
+        .order_by(_product_updates.c.id)
+    ).scalars().all()
+
+    version = bump_catalog_version(session, len(rows) - len(not_found))
+    now = datetime.utcnow()
+
+    # History first, it needs the old prices
+    price_changes = connection.execute(insert(ProductPriceHistory).from_select(
+        ["product_id", "catalog_version", "old_price", "new_price", "changed_at"],
+        select(Product.id, literal(version, Integer), Product.price, _product_updates.c.price, literal(now, DateTime))
+        .join(_product_updates, _product_updates.c.id == Product.id)
+        .where(_product_updates.c.price.is_not(None), _product_updates.c.price != Product.price)
+    )).rowcount
+
+    updated = connection.execute(
+        update(Product)
+        .where(Product.id == _product_updates.c.id)
+        .values(price=func.coalesce(_product_updates.c.price, Product.price),
+                active=func.coalesce(_product_updates.c.active, Product.active),
+                # Same soft delete bookkeeping as delete_product/restore_product
+                deleted_at=case(
+                    (_product_updates.c.active == True, None),
+                    ((_product_updates.c.active == False) & (Product.active != False), literal(now, DateTime)),
+                    else_=Product.deleted_at))
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    connection.execute(_product_updates.delete())
+
+    return {
+        "catalog_version": version,
+        "updated": updated,
+        "price_changes": price_changes,
+        "not_found": not_found,
+    }
@@ -0,0 +1,104 @@
+from collections import Counter
+from sqlalchemy import select, delete, insert, union_all, func, literal
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from database import get_session
+from objects import Customer, Order, OrderItem, ArchivedOrder, ArchivedOrderItem, Product, CustomerSummary, CustomerProductTotal
+
+# Number of products listed as a customer's favourites
+FAVOURITE_PRODUCTS = 3
+# Customers recomputed per transaction by rebuild_summaries
+REBUILD_BATCH_SIZE = 500
+
+def record_order(session, customer_id, items, ordered_at):
+    '''Adds a new order to the customer's summary. items is an iterable of (product_id, quantity, unit_price).
+    Call inside the session that creates the order so both commit together'''
+    quantities = Counter()
+    spend = 0
+    for product_id, quantity, unit_price in items:
+        quantities[product_id] += quantity
+        spend += (unit_price or 0) * quantity
+
+    summary = sqlite_insert(CustomerSummary).values(
+        customer_id=customer_id, order_count=1, lifetime_value=spend, last_order_at=ordered_at)
+    session.execute(summary.on_conflict_do_update(
+        index_elements=["customer_id"],
+        set_={
+            "order_count": CustomerSummary.order_count + 1,
+            "lifetime_value": CustomerSummary.lifetime_value + spend,
+            "last_order_at": func.max(func.coalesce(CustomerSummary.last_order_at, ordered_at), ordered_at),
+        }))
+
+    for product_id, quantity in quantities.items():
+        total = sqlite_insert(CustomerProductTotal).values(
+            customer_id=customer_id, product_id=product_id, quantity=quantity)
+        session.execute(total.on_conflict_do_update(
+            index_elements=["customer_id", "product_id"],
+            set_={"quantity": CustomerProductTotal.quantity + quantity}))
+
+def get_summary(session, customer_id, favourites=FAVOURITE_PRODUCTS):
+    '''Returns the customer's summary as a dict, customers without orders get zeroed totals'''
+    summary = session.get(CustomerSummary, customer_id)
+    favourite_products = (session.query(CustomerProductTotal.product_id, Product.name, CustomerProductTotal.quantity)
+                          .join(Product, Product.id == CustomerProductTotal.product_id)
+                          .filter(CustomerProductTotal.customer_id == customer_id)
+                          .order_by(CustomerProductTotal.quantity.desc(), CustomerProductTotal.product_id)
+                          .limit(favourites)
+                          .all())
+    return {
+        "order_count" : summary.order_count if summary else 0,
+        "lifetime_value" : summary.lifetime_value if summary else 0,
+        "last_order_at" : summary.last_order_at.isoformat() if summary and summary.last_order_at else None,
+        "favourite_products" : [
+            {"product_id" : product_id, "name" : name, "quantity" : quantity}
+            for product_id, name, quantity in favourite_products
+        ]
+    }
+
+def _order_lines(customer_ids):
+    '''One row per order item (or per empty order) across the hot and archive tables'''
+    hot = (select(Order.customer_id, Order.id.label("order_id"), Order.created_at,
+                  OrderItem.product_id, OrderItem.quantity, OrderItem.unit_price)
+           .outerjoin(OrderItem, OrderItem.order_id == Order.id)
+           .where(Order.customer_id.in_(customer_ids)))
+    archived = (select(ArchivedOrder.customer_id, ArchivedOrder.id.label("order_id"), ArchivedOrder.created_at,
+                       ArchivedOrderItem.product_id, ArchivedOrderItem.quantity, ArchivedOrderItem.unit_price)
+                .outerjoin(ArchivedOrderItem, ArchivedOrderItem.order_id == ArchivedOrder.id)
+                .where(ArchivedOrder.customer_id.in_(customer_ids)))
+    return union_all(hot, archived).subquery()
+
+def _rebuild_batch(session, customer_ids):
+    session.execute(delete(CustomerProductTotal).where(CustomerProductTotal.customer_id.in_(customer_ids)))
+    session.execute(delete(CustomerSummary).where(CustomerSummary.customer_id.in_(customer_ids)))
+
+    lines = _order_lines(customer_ids)
+    session.execute(insert(CustomerSummary).from_select(
+        ["customer_id", "order_count", "lifetime_value", "last_order_at"],
+        select(lines.c.customer_id,
+               func.count(lines.c.order_id.distinct()),
+               # Valued at the price paid, the same as record_order
+               func.coalesce(func.sum(lines.c.quantity * lines.c.unit_price), literal(0.0)),
+               func.max(lines.c.created_at))
+        .group_by(lines.c.customer_id)
+    ))
+    session.execute(insert(CustomerProductTotal).from_select(
+        ["customer_id", "product_id", "quantity"],
+        select(lines.c.customer_id, lines.c.product_id, func.sum(lines.c.quantity))
+        .where(lines.c.product_id.is_not(None))
+        .group_by(lines.c.customer_id, lines.c.product_id)
+    ))
+
+def rebuild_summaries(batch_size=REBUILD_BATCH_SIZE):
+    '''Recomputes every customer summary from the order items, batch_size customers per transaction.
+    Returns the number of customers processed'''
+    last_id = 0
+    total = 0
+    while True:
+        with get_session() as session:
+            customer_ids = session.execute(
+                select(Customer.id).where(Customer.id > last_id).order_by(Customer.id).limit(batch_size)
+            ).scalars().all()
+            if not customer_ids:
+                return total
+            _rebuild_batch(session, customer_ids)
+        last_id = customer_ids[-1]
+        total += len(customer_ids)
@@ -1,12 +1,38 @@
-from sqlalchemy import create_engine
+import os
+import random
+import threading
+import time
+from contextvars import ContextVar
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import sessionmaker, declarative_base
 from contextlib import contextmanager
 
-# SQLite database URL
-DATABASE_URL = "sqlite:///ecommerce.db"
+# SQLite database URL, overridable so tools can point the app at a scratch database
+DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite:///ecommerce.db")
+
+# Seconds SQLite itself waits on a locked database before raising "database is locked"
+SQLITE_BUSY_TIMEOUT = 1.0
+# Further attempts get_session makes to take the write lock, with exponential backoff between them
+LOCK_RETRIES = 5
+LOCK_BACKOFF = 0.05
+LOCK_BACKOFF_MAX = 1.0
 
 # Create the engine
-engine = create_engine(DATABASE_URL, echo=True)
+engine = create_engine(DATABASE_URL, echo=True, connect_args={"timeout": SQLITE_BUSY_TIMEOUT})
+
+# pysqlite normally issues its own deferred BEGIN just before the first write.
+# Turn that off and begin transactions ourselves, so a write session can take
+# the lock up front with BEGIN IMMEDIATE, before any of its work has run
+@event.listens_for(engine, "connect")
+def _disable_pysqlite_begin(dbapi_connection, connection_record):
+    dbapi_connection.isolation_level = None
+
+@event.listens_for(engine, "begin")
+def _begin(connection):
+    options = connection.get_execution_options()
+    if options.get("isolation_level") != "AUTOCOMMIT":
+        connection.exec_driver_sql(options.get("sqlite_begin", "BEGIN"))
 
 # Define the Base for declarative models
 Base = declarative_base()
@@ -15,17 +41,91 @@ Base = declarative_base()
 Base.metadata.create_all(engine)
 
 # Create a session factory
-Session = sessionmaker(bind=engine)
+# Objects stay readable after get_session commits, views render them once the block has exited
+Session = sessionmaker(bind=engine, expire_on_commit=False)
+
+class LockStats:
+    '''Process-wide counters for get_session's write lock, read by the stress harness'''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.acquired = 0
+            self.retries = 0
+            self.failures = 0
+            self.wait_seconds = 0.0
+
+    def record(self, waited, retries, acquired):
+        with self._lock:
+            self.wait_seconds += waited
+            self.retries += retries
+            if acquired:
+                self.acquired += 1
+            else:
+                self.failures += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {"acquired": self.acquired, "retries": self.retries,
+                    "failures": self.failures, "wait_seconds": self.wait_seconds}
+
+lock_stats = LockStats()
+
+def _is_locked_error(error):
+    return "database is locked" in str(error.orig)
+
+def _begin_write(session):
+    '''Starts the session's transaction with BEGIN IMMEDIATE, retrying while another writer holds the lock'''
+    start = time.perf_counter()
+    for attempt in range(LOCK_RETRIES + 1):
+        try:
+            session.connection(execution_options={"sqlite_begin": "BEGIN IMMEDIATE"})
+            lock_stats.record(time.perf_counter() - start, attempt, acquired=True)
+            return
+        except OperationalError as e:
+            session.rollback()
+            if not _is_locked_error(e) or attempt == LOCK_RETRIES:
+                lock_stats.record(time.perf_counter() - start, attempt, acquired=False)
+                raise
+        # Jitter so writers that collided don't retry in lockstep
+        backoff = min(LOCK_BACKOFF * 2 ** attempt, LOCK_BACKOFF_MAX)
+        time.sleep(backoff * random.uniform(0.5, 1.0))
 
 # function to get a db session, with context manager
+# Write sessions hold SQLite's write lock for the whole block, so the block should
+# not commit part way through, and reads should pass write=False
 @contextmanager
-def get_session():
+def get_session(write=True):
+    shared = _shared_session.get()
+    if shared is not None:
+        # Inside shared_session(), which commits or rolls back the whole unit of work
+        yield shared
+        return
+
     session = Session()
     try:
+        if write:
+            _begin_write(session)
         yield session
         session.commit()
     except:
         session.rollback()
         raise
     finally:
-        session.close()
\ No newline at end of file
+        session.close()
+
+# Session every get_session() block joins while a shared_session() block is running
+_shared_session = ContextVar("shared_session", default=None)
+
+@contextmanager
+def shared_session():
+    '''Runs every get_session() block inside it in a single write transaction, so
+    work done by a view and by the code wrapping it commits or rolls back together'''
+    with get_session() as session:
+        token = _shared_session.set(session)
+        try:
+            yield session
+        finally:
+            _shared_session.reset(token)
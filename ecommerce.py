@@ -0,0 +1,306 @@
+'''Command line entry point
+
+    python3 -m ecommerce serve --workers 4 --port 8000
+    python3 -m ecommerce bench-startup
+    python3 -m ecommerce bench-bulk-prices --products 50000
+    python3 -m ecommerce stress --workers 8 --duration 10
+
+serve preloads the Flask app once in a master process and forks worker processes that
+share its listening socket. Workers are replaced after --max-requests requests or once
+their memory passes --max-memory, and SIGTERM/SIGINT stops them after their current request.
+Workers that crash within --min-worker-lifetime of starting are respawned with a growing delay, and
+the master gives up after --max-quick-exits of them in a row. One more child runs the scheduled jobs
+(order archiving, purging deleted rows and expired idempotency keys) unless --no-background-jobs.
+Only the standard library is imported at module level so the CLI itself starts instantly,
+the app is imported by the command that needs it.
+'''
+import argparse
+import os
+import random
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+# Seconds the master waits before replacing a worker that died young, doubled on each quick exit in a row
+RESPAWN_BACKOFF = 0.1
+RESPAWN_BACKOFF_MAX = 10.0
+
+def _preload_app():
+    from app import app
+    from database import engine
+    # SQL echo logging costs more than the queries themselves under load
+    engine.echo = False
+    return app, engine
+
+def _memory_mb():
+    '''Peak resident memory of this process in MB (ru_maxrss is KB on Linux, bytes on macOS)'''
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1024 * 1024) if sys.platform == "darwin" else maxrss / 1024
+
+def _run_worker(app, engine, sock, args):
+    from werkzeug.serving import make_server
+
+    # Connections inherited from the master must not be shared with it
+    engine.dispose(close=False)
+
+    stopping = False
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    handled = 0
+    def counted_app(environ, start_response):
+        nonlocal handled
+        handled += 1
+        return app(environ, start_response)
+
+    server = make_server(args.host, args.port, counted_app, fd=sock.fileno())
+    # Wake up regularly to check whether we should stop
+    server.timeout = 1.0
+
+    # Jitter so workers started together don't all recycle together
+    max_requests = args.max_requests + random.randint(0, args.max_requests_jitter) if args.max_requests else 0
+    while not stopping:
+        server.handle_request()
+        if max_requests and handled >= max_requests:
+            break
+        if args.max_memory and _memory_mb() > args.max_memory:
+            break
+    server.server_close()
+    os._exit(0)
+
+def _run_jobs(app, engine, sock, args):
+    from app import start_background_jobs
+
+    engine.dispose(close=False)
+    # This process doesn't serve requests
+    sock.close()
+
+    # Block SIGTERM before starting the job threads so only sigwait below receives it.
+    # Each job batch is its own transaction, exiting part way through one rolls it back
+    signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGTERM})
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    start_background_jobs()
+    signal.sigwait({signal.SIGTERM})
+    os._exit(0)
+
+def serve(args):
+    app, engine = _preload_app()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((args.host, args.port))
+    sock.listen(args.backlog)
+    sock.set_inheritable(True)
+
+    # Don't hand pooled connections to the children
+    engine.dispose()
+
+    # pid: (time.monotonic() when the child was forked, what it runs)
+    workers = {}
+    def spawn(target=_run_worker):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                target(app, engine, sock, args)
+            except BaseException:
+                traceback.print_exc()
+            os._exit(1)
+        workers[pid] = (time.monotonic(), target)
+
+    def signal_workers(signum):
+        for pid in list(workers):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    shutting_down = False
+    def shutdown(signum, frame):
+        # waitpid resumes after a handler returns, so stop the workers here to wake it up
+        nonlocal shutting_down
+        shutting_down = True
+        signal_workers(signal.SIGTERM)
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    for _ in range(args.workers):
+        spawn()
+    if args.background_jobs:
+        spawn(_run_jobs)
+    print(f"Serving on http://{args.host}:{args.port} with {args.workers} worker(s)"
+          + (" and a background jobs process" if args.background_jobs else ""))
+
+    failed = False
+    quick_exits = 0
+    while not shutting_down:
+        try:
+            pid, status = os.waitpid(-1, 0)
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        child = workers.pop(pid, None)
+        if shutting_down or child is None:
+            continue
+        started, target = child
+
+        # Recycled or crashed, either way keep the pool full. A worker that crashes straight
+        # after starting will most likely do so again, so slow down instead of fork-looping.
+        # Busy workers can reach --max-requests quickly, so clean exits don't count
+        exit_code = os.waitstatus_to_exitcode(status)
+        if exit_code == 0 or time.monotonic() - started >= args.min_worker_lifetime:
+            quick_exits = 0
+        else:
+            quick_exits += 1
+            if quick_exits >= args.max_quick_exits:
+                print(f"{quick_exits} child process(es) in a row crashed within {args.min_worker_lifetime:g} s of starting, "
+                      f"giving up (last exit status {exit_code})", file=sys.stderr)
+                failed = True
+                shutdown(None, None)
+                break
+            backoff = min(RESPAWN_BACKOFF * 2 ** (quick_exits - 1), RESPAWN_BACKOFF_MAX)
+            deadline = time.monotonic() + backoff
+            while not shutting_down and time.monotonic() < deadline:
+                time.sleep(0.05)
+        if not shutting_down:
+            spawn(target)
+
+    deadline = time.monotonic() + args.graceful_timeout
+    while workers and time.monotonic() < deadline:
+        pid, status = os.waitpid(-1, os.WNOHANG)
+        if pid:
+            workers.pop(pid, None)
+        else:
+            time.sleep(0.05)
+    signal_workers(signal.SIGKILL)
+    sock.close()
+    if failed:
+        sys.exit(1)
+
+BENCH_SCRIPT = '''
+import time
+start = time.perf_counter()
+from app import app
+imported = time.perf_counter()
+from database import engine
+engine.echo = False
+app.test_client().get("/products?format=json")
+first_request = time.perf_counter()
+print(imported - start, first_request - start)
+'''
+
+def bench_startup(args):
+    '''Times importing the app and serving its first request in fresh interpreters'''
+    here = os.path.dirname(os.path.abspath(__file__))
+    imports, first_requests = [], []
+    for _ in range(args.runs):
+        result = subprocess.run([sys.executable, "-c", BENCH_SCRIPT], cwd=here,
+                                capture_output=True, text=True, check=True)
+        imported, first_request = map(float, result.stdout.split()[-2:])
+        imports.append(imported)
+        first_requests.append(first_request)
+
+    imports.sort()
+    first_requests.sort()
+    print(f"{args.runs} run(s)")
+    print(f"import app:     min {imports[0] * 1000:.1f} ms, median {imports[len(imports) // 2] * 1000:.1f} ms")
+    print(f"first request:  min {first_requests[0] * 1000:.1f} ms, median {first_requests[len(first_requests) // 2] * 1000:.1f} ms")
+
+def bench_bulk_prices(args):
+    '''Compares PATCH /products/bulk's set-based update with per-product ORM updates on a scratch database'''
+    from sqlalchemy import create_engine, insert
+    from sqlalchemy.orm import sessionmaker
+    from database import Base
+    from objects import Product
+    from catalog import bulk_update_products
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine(f"sqlite:///{os.path.join(directory, 'bench.db')}")
+        Base.metadata.create_all(engine)
+        Session = sessionmaker(bind=engine)
+
+        with Session.begin() as session:
+            session.execute(insert(Product), [
+                {"id": i, "name": f"Product {i}", "price": 10.0, "active": True}
+                for i in range(1, args.products + 1)
+            ])
+
+        changes = [{"id": i, "price": 12.5} for i in range(1, args.products + 1)]
+        start = time.perf_counter()
+        with Session.begin() as session:
+            result = bulk_update_products(session, changes)
+        bulk_seconds = time.perf_counter() - start
+
+        sample = min(args.per_row_sample, args.products)
+        start = time.perf_counter()
+        for i in range(1, sample + 1):
+            with Session.begin() as session:
+                session.get(Product, i).price = 15.0
+        per_row_seconds = time.perf_counter() - start
+        engine.dispose()
+
+    print(f"bulk update:    {result['updated']} products in {bulk_seconds:.2f} s, {result['updated'] / bulk_seconds:,.0f} products/s")
+    print(f"per-row update: {sample} products in {per_row_seconds:.2f} s, {sample / per_row_seconds:,.0f} products/s")
+
+def _run_stress(args):
+    from stress import run_stress
+    run_stress(args)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="ecommerce")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = commands.add_parser("serve", help="Run the app with multiple worker processes")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8000)
+    serve_parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    serve_parser.add_argument("--backlog", type=int, default=128)
+    serve_parser.add_argument("--max-requests", type=int, default=1000,
+                              help="Recycle a worker after this many requests, 0 to never recycle")
+    serve_parser.add_argument("--max-requests-jitter", type=int, default=100)
+    serve_parser.add_argument("--max-memory", type=int, default=512,
+                              help="Recycle a worker once its peak memory passes this many MB, 0 for no limit")
+    serve_parser.add_argument("--graceful-timeout", type=float, default=30,
+                              help="Seconds to let workers finish on shutdown before killing them")
+    serve_parser.add_argument("--min-worker-lifetime", type=float, default=5,
+                              help="Workers crashing sooner than this many seconds after starting are respawned with a backoff")
+    serve_parser.add_argument("--max-quick-exits", type=int, default=5,
+                              help="Stop the server after this many such crashes in a row")
+    serve_parser.add_argument("--no-background-jobs", dest="background_jobs", action="store_false",
+                              help="Don't run the scheduled jobs, for when another server or cron runs them")
+    serve_parser.set_defaults(func=serve)
+
+    bench_parser = commands.add_parser("bench-startup", help="Time app import and first request")
+    bench_parser.add_argument("--runs", type=int, default=5)
+    bench_parser.set_defaults(func=bench_startup)
+
+    bulk_parser = commands.add_parser("bench-bulk-prices", help="Time bulk price updates against per-product updates")
+    bulk_parser.add_argument("--products", type=int, default=50000)
+    bulk_parser.add_argument("--per-row-sample", type=int, default=2000,
+                             help="Products updated one at a time for comparison")
+    bulk_parser.set_defaults(func=bench_bulk_prices)
+
+    stress_parser = commands.add_parser("stress", help="Concurrent write stress test with consistency checks")
+    stress_parser.add_argument("--workers", type=int, default=8)
+    stress_parser.add_argument("--processes", action="store_true",
+                               help="Run workers as processes instead of threads")
+    stress_parser.add_argument("--duration", type=float, default=10, help="Seconds per journal mode")
+    stress_parser.add_argument("--journal-mode", choices=["wal", "delete", "both"], default="both")
+    stress_parser.add_argument("--customers", type=int, default=50)
+    stress_parser.add_argument("--products", type=int, default=200)
+    stress_parser.add_argument("--read-ratio", type=float, default=0.5)
+    stress_parser.set_defaults(func=_run_stress)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+import hashlib
+import threading
+import time
+from datetime import datetime, timedelta
+from functools import wraps
+from flask import request, jsonify, make_response
+from sqlalchemy import delete
+from sqlalchemy.exc import IntegrityError
+from database import get_session, shared_session
+from objects import IdempotencyKey
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+# How long a stored response is replayed for
+IDEMPOTENCY_KEY_TTL = timedelta(hours=24)
+# How long a retry waits for the first request to finish. A key still pending after this
+# belongs to a request that died, and is handed to the retry
+IN_FLIGHT_TIMEOUT = 30
+IN_FLIGHT_POLL_INTERVAL = 0.05
+
+# Requests currently being executed by this process, so local retries
+# can wait on an Event instead of polling the database
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+def _request_hash():
+    return hashlib.sha256(request.get_data()).hexdigest()
+
+def _claim(key, request_hash, claimed_at):
+    '''Inserts a pending row for key, dated claimed_at. Returns None if this request now owns
+    the key, otherwise the existing IdempotencyKey row (detached)'''
+    try:
+        with get_session() as session:
+            session.add(IdempotencyKey(key=key, request_hash=request_hash, created_at=claimed_at))
+        return None
+    except IntegrityError:
+        pass
+
+    with get_session() as session:
+        existing = session.get(IdempotencyKey, key)
+        if existing is None:
+            # Purged between the insert and the read, try again
+            return _claim(key, request_hash, claimed_at)
+        now = datetime.utcnow()
+        expired = existing.created_at < now - IDEMPOTENCY_KEY_TTL
+        # This is a write session, and a live owner holds the write lock from the start of its
+        # view until its response is stored, in one transaction. So a key still pending here
+        # after IN_FLIGHT_TIMEOUT belongs to a request that died without committing anything
+        abandoned = (existing.status_code is None
+                     and existing.created_at < now - timedelta(seconds=IN_FLIGHT_TIMEOUT))
+        if expired or abandoned:
+            session.delete(existing)
+            session.flush()
+            existing = None
+        else:
+            session.expunge(existing)
+    if existing is None:
+        return _claim(key, request_hash, claimed_at)
+    return existing
+
+def _wait_for_response(key):
+    '''Blocks until the request owning key has finished. Returns the stored row (still pending
+    if the wait timed out), or None if the owner failed and released the key'''
+    with _in_flight_lock:
+        event = _in_flight.get(key)
+    if event is not None:
+        event.wait(IN_FLIGHT_TIMEOUT)
+
+    # The owner may be another process, so fall back to polling
+    deadline = time.monotonic() + IN_FLIGHT_TIMEOUT
+    while True:
+        with get_session(write=False) as session:
+            stored = session.get(IdempotencyKey, key)
+            if stored is not None:
+                session.expunge(stored)
+        if stored is None or stored.status_code is not None or time.monotonic() >= deadline:
+            return stored
+        time.sleep(IN_FLIGHT_POLL_INTERVAL)
+
+def _replay(stored):
+    response = make_response(stored.response_body, stored.status_code)
+    response.mimetype = stored.mimetype
+    response.headers["Idempotent-Replayed"] = "true"
+    return response
+
+def idempotent(view):
+    '''Makes a POST/PATCH view safe to retry when the client sends an Idempotency-Key header.
+    The first request runs the view and stores its response, repeats with the same key
+    get the stored response back and concurrent repeats wait for the first to finish'''
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        client_key = request.headers.get(IDEMPOTENCY_HEADER)
+        if not client_key:
+            return view(*args, **kwargs)
+
+        # Scope keys to the endpoint so one key can't replay a different route's response
+        key = f"{request.method} {request.path} {client_key}"
+        request_hash = _request_hash()
+
+        claimed_at = datetime.utcnow()
+        stored = _claim(key, request_hash, claimed_at)
+        if stored is not None and stored.status_code is None and stored.request_hash == request_hash:
+            stored = _wait_for_response(key)
+            if stored is None or stored.status_code is None:
+                # The first request failed and released the key, or died and left it pending,
+                # try to take it over and run this one instead
+                claimed_at = datetime.utcnow()
+                stored = _claim(key, request_hash, claimed_at)
+        if stored is not None:
+            if stored.request_hash != request_hash:
+                return jsonify({"error": f"{IDEMPOTENCY_HEADER} was already used with a different request"}), 422
+            if stored.status_code is None:
+                return jsonify({"error": "A request with this key is still in progress"}), 409
+            return _replay(stored)
+
+        event = threading.Event()
+        with _in_flight_lock:
+            _in_flight[key] = event
+        try:
+            # The view's get_session() blocks join this transaction, so its work and the
+            # stored response commit together
+            with shared_session() as session:
+                record = session.get(IdempotencyKey, key)
+                if record is None or record.created_at != claimed_at:
+                    # Stalled past IN_FLIGHT_TIMEOUT and a retry took the key over, it runs the view instead
+                    return jsonify({"error": "A request with this key is still in progress"}), 409
+                response = make_response(view(*args, **kwargs))
+                if response.status_code >= 500:
+                    # Let the client retry
+                    session.delete(record)
+                else:
+                    record.status_code = response.status_code
+                    record.response_body = response.get_data(as_text=True)
+                    record.mimetype = response.mimetype
+            return response
+        except Exception:
+            _release(key)
+            raise
+        finally:
+            with _in_flight_lock:
+                _in_flight.pop(key, None)
+            event.set()
+    return wrapper
+
+def _release(key):
+    '''Drops a pending key so the request can be retried'''
+    with get_session() as session:
+        session.execute(delete(IdempotencyKey).where(IdempotencyKey.key == key))
+
+def purge_expired_keys(ttl=IDEMPOTENCY_KEY_TTL):
+    '''Deletes stored responses older than ttl, returns the number removed'''
+    with get_session() as session:
+        result = session.execute(delete(IdempotencyKey).where(IdempotencyKey.created_at < datetime.utcnow() - ttl))
+        return result.rowcount
+
+def start_key_purger(interval=3600, ttl=IDEMPOTENCY_KEY_TTL):
+    '''Runs purge_expired_keys every interval seconds on a daemon thread'''
+    def run():
+        while True:
+            try:
+                purged = purge_expired_keys(ttl)
+                if purged:
+                    print(f"Purged {purged} idempotency key(s)")
+            except Exception as e:
+                print(f"Purging idempotency keys failed: {e}")
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, name="idempotency-key-purger", daemon=True)
+    thread.start()
+    return thread
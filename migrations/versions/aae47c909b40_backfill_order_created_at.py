@@ -0,0 +1,29 @@
+"""backfill order created_at
+
+Revision ID: aae47c909b40
+Revises: 9326f2e0e3a9
+Create Date: 2026-10-19 19:57:06.695289
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'aae47c909b40'
+down_revision: Union[str, None] = '9326f2e0e3a9'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Orders placed before created_at existed have no date, and "created_at < cutoff" never
+    # matches NULL, so they would never be archived. Date them from the upgrade so they age
+    # out after ARCHIVE_AFTER_DAYS like any other order
+    op.execute("UPDATE orders SET created_at = CURRENT_TIMESTAMP WHERE created_at IS NULL")
+
+
+def downgrade() -> None:
+    # The backfilled dates can't be told apart from real ones, so they are kept
+    pass
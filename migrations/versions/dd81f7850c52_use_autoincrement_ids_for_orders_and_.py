@@ -0,0 +1,40 @@
+"""use autoincrement ids for orders and order items
+
+Revision ID: dd81f7850c52
+Revises: 471451355a96
+Create Date: 2026-10-19 19:46:30.460633
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'dd81f7850c52'
+down_revision: Union[str, None] = '471451355a96'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# (table, archive table) pairs whose ids must never be reused
+TABLES = [("orders", "orders_archive"), ("order_items", "order_items_archive")]
+
+
+def upgrade() -> None:
+    for table, archive in TABLES:
+        # SQLite can only add AUTOINCREMENT by rebuilding the table
+        with op.batch_alter_table(table, recreate="always", table_kwargs={"sqlite_autoincrement": True}):
+            pass
+        # Start the counter above every id already used, including rows moved to the archive
+        op.execute(f"DELETE FROM sqlite_sequence WHERE name = '{table}'")
+        op.execute(
+            f"INSERT INTO sqlite_sequence (name, seq) SELECT '{table}', "
+            f"MAX(COALESCE((SELECT MAX(id) FROM {table}), 0), COALESCE((SELECT MAX(id) FROM {archive}), 0))"
+        )
+
+
+def downgrade() -> None:
+    for table, archive in reversed(TABLES):
+        with op.batch_alter_table(table, recreate="always", table_kwargs={"sqlite_autoincrement": False}):
+            pass
@@ -1,4 +1,5 @@
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, Boolean
+from datetime import datetime
+from sqlalchemy import Column, Integer, String, Float, ForeignKey, Boolean, DateTime, Text, Index, text
 from sqlalchemy.orm import declarative_base, relationship
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
@@ -17,8 +18,16 @@ class Customer(UserMixin, Base):
     name = Column(String, nullable=False)
     email = Column(String, unique=True, nullable=False)
     active = Column(Boolean, default=True)
+    deleted_at = Column(DateTime, nullable=True)
     password_hash = Column(String, nullable=True)
     orders = relationship("Order", back_populates="customer")
+    summary = relationship("CustomerSummary", back_populates="customer", uselist=False)
+
+    # Partial indexes, each only holds the rows its listing reads
+    __table_args__ = (
+        Index("ix_customers_active", "id", sqlite_where=text("active = 1")),
+        Index("ix_customers_deleted", "deleted_at", sqlite_where=text("active = 0")),
+    )
 
     def set_password(self, password):
         '''Sets the Customer password'''
@@ -32,10 +41,14 @@ class Customer(UserMixin, Base):
 class Order(Base):
     __tablename__ = "orders"
     id = Column(Integer, primary_key=True)
-    customer_id = Column(Integer, ForeignKey("customers.id"), nullable=False)
+    customer_id = Column(Integer, ForeignKey("customers.id"), nullable=False, index=True)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
     customer = relationship("Customer", back_populates="orders")
     items = relationship("OrderItem", back_populates="order")
 
+    # Ids are never reused, archived orders keep theirs
+    __table_args__ = {"sqlite_autoincrement": True}
+
 # Define product table
 class Product(Base):
     __tablename__ = "products"
@@ -43,14 +56,90 @@ class Product(Base):
     name = Column(String, nullable=False)
     price = Column(Float, nullable=False)
     active = Column(Boolean, default=True)
+    deleted_at = Column(DateTime, nullable=True)
     items = relationship("OrderItem", back_populates="product")
 
+    __table_args__ = (
+        Index("ix_products_active", "id", sqlite_where=text("active = 1")),
+        Index("ix_products_deleted", "deleted_at", sqlite_where=text("active = 0")),
+    )
+
 # Define the OrderItem table (many-to-many relationship between orders and products)
 class OrderItem(Base):
     __tablename__ = "order_items"
     id = Column(Integer, primary_key=True)
     order_id = Column(Integer, ForeignKey("orders.id"), nullable=False)
-    product_id = Column(Integer, ForeignKey("products.id"), nullable=False)
+    product_id = Column(Integer, ForeignKey("products.id"), nullable=False, index=True)
     quantity = Column(Integer, nullable=False)
+    # Product price when the order was placed
+    unit_price = Column(Float, nullable=True)
     order = relationship("Order", back_populates="items")
     product = relationship("Product", back_populates="items")
+
+    __table_args__ = {"sqlite_autoincrement": True}
+
+class ArchivedOrder(Base):
+    '''Cold copy of an Order moved out of the hot table by archive.py'''
+    __tablename__ = "orders_archive"
+    id = Column(Integer, primary_key=True)
+    customer_id = Column(Integer, ForeignKey("customers.id"), nullable=False, index=True)
+    created_at = Column(DateTime)
+    archived_at = Column(DateTime, nullable=False)
+    customer = relationship("Customer")
+    items = relationship("ArchivedOrderItem", back_populates="order")
+
+class ArchivedOrderItem(Base):
+    '''Cold copy of an OrderItem, keyed to its ArchivedOrder'''
+    __tablename__ = "order_items_archive"
+    id = Column(Integer, primary_key=True)
+    order_id = Column(Integer, ForeignKey("orders_archive.id"), nullable=False, index=True)
+    product_id = Column(Integer, ForeignKey("products.id"), nullable=False, index=True)
+    quantity = Column(Integer, nullable=False)
+    unit_price = Column(Float, nullable=True)
+    order = relationship("ArchivedOrder", back_populates="items")
+    product = relationship("Product")
+
+class IdempotencyKey(Base):
+    '''Stored response for a POST sent with an Idempotency-Key header, see idempotency.py'''
+    __tablename__ = "idempotency_keys"
+    key = Column(String, primary_key=True)
+    request_hash = Column(String, nullable=False)
+    created_at = Column(DateTime, nullable=False, index=True)
+    # Null until the first request finishes
+    status_code = Column(Integer, nullable=True)
+    response_body = Column(Text, nullable=True)
+    mimetype = Column(String, nullable=True)
+
+class CustomerSummary(Base):
+    '''Per-customer order totals, kept up to date by customer_stats.py'''
+    __tablename__ = "customer_summaries"
+    customer_id = Column(Integer, ForeignKey("customers.id"), primary_key=True)
+    order_count = Column(Integer, nullable=False, default=0)
+    lifetime_value = Column(Float, nullable=False, default=0, index=True)
+    last_order_at = Column(DateTime, nullable=True)
+    customer = relationship("Customer", back_populates="summary")
+
+class CustomerProductTotal(Base):
+    '''Quantity of each product a customer has ordered, used to find their favourites'''
+    __tablename__ = "customer_product_totals"
+    customer_id = Column(Integer, ForeignKey("customers.id"), primary_key=True)
+    product_id = Column(Integer, ForeignKey("products.id"), primary_key=True, index=True)
+    quantity = Column(Integer, nullable=False, default=0)
+    product = relationship("Product")
+
+class CatalogVersion(Base):
+    '''Bumped on every product change, the latest id keys product caches and ETags'''
+    __tablename__ = "catalog_versions"
+    id = Column(Integer, primary_key=True)
+    created_at = Column(DateTime, nullable=False)
+    products_changed = Column(Integer, nullable=False, default=0)
+
+class ProductPriceHistory(Base):
+    '''One row per price change, tagged with the catalog version that made it'''
+    __tablename__ = "product_price_history"
+    id = Column(Integer, primary_key=True)
+    product_id = Column(Integer, ForeignKey("products.id"), nullable=False, index=True)
+    catalog_version = Column(Integer, ForeignKey("catalog_versions.id"), nullable=False)
+    old_price = Column(Float, nullable=False)
+    new_price = Column(Float, nullable=False)
+    changed_at = Column(DateTime, nullable=False)
@@ -0,0 +1,103 @@
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import select, delete, exists
+from database import engine, get_session
+from catalog import bump_catalog_version
+from objects import (Customer, Product, Order, OrderItem, ArchivedOrder, ArchivedOrderItem,
+                     CustomerSummary, CustomerProductTotal, ProductPriceHistory)
+
+# Soft deleted rows are kept this long so they can still be restored
+PURGE_RETENTION_DAYS = 90
+# Rows hard deleted per transaction
+PURGE_BATCH_SIZE = 200
+# Free pages handed back to the filesystem per compaction
+VACUUM_PAGES = 1000
+
+# model: (columns that must not reference a purged row, rows removed along with it)
+# Customers and products that appear in order history are kept, their orders still point at them
+# Every reference column is indexed, so each check is a lookup rather than a table scan
+_PURGEABLE = {
+    Customer: ([Order.customer_id, ArchivedOrder.customer_id],
+               [CustomerSummary.customer_id, CustomerProductTotal.customer_id]),
+    Product: ([OrderItem.product_id, ArchivedOrderItem.product_id, CustomerProductTotal.product_id],
+              [ProductPriceHistory.product_id]),
+}
+
+def purge_batch(session, model, cutoff, batch_size=PURGE_BATCH_SIZE):
+    '''Hard deletes up to batch_size rows of model soft deleted before cutoff. Returns the number deleted'''
+    references, dependents = _PURGEABLE[model]
+    query = (select(model.id)
+             .where(model.active == False, model.deleted_at < cutoff)
+             .order_by(model.deleted_at)
+             .limit(batch_size))
+    for column in references:
+        query = query.where(~exists().where(column == model.id))
+
+    ids = session.execute(query).scalars().all()
+    if not ids:
+        return 0
+
+    for column in dependents:
+        session.execute(delete(column.table).where(column.in_(ids)))
+    session.execute(delete(model).where(model.id.in_(ids)))
+    if model is Product:
+        # Cached product ETags must not outlive the products they describe
+        bump_catalog_version(session, len(ids))
+    return len(ids)
+
+def purge_deleted(retention_days=PURGE_RETENTION_DAYS, batch_size=PURGE_BATCH_SIZE, pause=0.0):
+    '''Hard deletes customers and products soft deleted more than retention_days ago,
+    one batch per transaction. Returns the number of rows deleted per table'''
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    purged = {}
+    for model in _PURGEABLE:
+        total = 0
+        while True:
+            with get_session() as session:
+                deleted = purge_batch(session, model, cutoff, batch_size)
+            total += deleted
+            if deleted < batch_size:
+                break
+            if pause:
+                time.sleep(pause)
+        purged[model.__tablename__] = total
+    return purged
+
+def enable_incremental_vacuum():
+    '''Switches the database to incremental auto vacuum. Rewrites the whole file once, run while the app is stopped'''
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
+        connection.exec_driver_sql("VACUUM")
+
+def compact(pages=VACUUM_PAGES):
+    '''Returns up to pages free pages to the filesystem. Returns the number freed,
+    or None if incremental vacuum hasn't been enabled'''
+    connection = engine.raw_connection()
+    try:
+        # 2 = INCREMENTAL
+        if connection.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            return None
+        free_before = connection.execute("PRAGMA freelist_count").fetchone()[0]
+        # execute() only steps the pragma once (one page), executescript runs it to completion
+        connection.driver_connection.executescript(f"PRAGMA incremental_vacuum({int(pages)})")
+        return free_before - connection.execute("PRAGMA freelist_count").fetchone()[0]
+    finally:
+        connection.close()
+
+def start_purger(interval=86400, retention_days=PURGE_RETENTION_DAYS, batch_size=PURGE_BATCH_SIZE, pause=0.1):
+    '''Runs purge_deleted then compact every interval seconds on a daemon thread'''
+    def run():
+        while True:
+            try:
+                purged = purge_deleted(retention_days, batch_size, pause)
+                if any(purged.values()):
+                    print(f"Purged deleted rows: {purged}")
+                compact()
+            except Exception as e:
+                print(f"Purging deleted rows failed: {e}")
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, name="deleted-row-purger", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,233 @@
+'''Concurrent write stress test for get_session and the JSON routes
+
+    python3 -m ecommerce stress --workers 8 --duration 10
+    python3 -m ecommerce stress --processes --journal-mode wal
+
+Each run builds a scratch SQLite database, hammers the write routes (orders, products,
+bulk price changes, idempotent retries) from several threads or processes alongside
+read traffic, then checks the data is consistent and reports throughput and lock waits.
+The app is imported only after DATABASE_URL points at the scratch database.
+'''
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+JOURNAL_MODES = ["wal", "delete"]
+
+def _setup(database_path, journal_mode, customers, products):
+    os.environ["DATABASE_URL"] = f"sqlite:///{database_path}"
+    from sqlalchemy import insert
+    from database import Base, engine
+    from objects import Customer, Product
+
+    engine.echo = False
+    Base.metadata.create_all(engine)
+    connection = engine.raw_connection()
+    try:
+        connection.execute(f"PRAGMA journal_mode = {journal_mode}")
+    finally:
+        connection.close()
+
+    with engine.begin() as connection:
+        connection.execute(insert(Customer), [
+            {"id": i, "name": f"Customer {i}", "email": f"customer{i}@example.com", "active": True}
+            for i in range(1, customers + 1)
+        ])
+        connection.execute(insert(Product), [
+            {"id": i, "name": f"Product {i}", "price": 10.0, "active": True}
+            for i in range(1, products + 1)
+        ])
+
+    from app import app
+    app.config["WTF_CSRF_ENABLED"] = False
+    # Let exceptions reach the worker so they can be counted by type
+    app.config["PROPAGATE_EXCEPTIONS"] = True
+    return app, engine
+
+def _worker(app, worker_id, duration, customers, products, read_ratio):
+    '''Sends a random mix of requests until duration has passed, returns what happened'''
+    from database import lock_stats
+
+    rng = random.Random(worker_id)
+    client = app.test_client()
+    result = {"writes": Counter(), "reads": 0, "errors": Counter(), "orders": [],
+              "idempotent_mismatches": 0, "product_writes": 0}
+
+    deadline = time.monotonic() + duration
+    sequence = 0
+    while time.monotonic() < deadline:
+        sequence += 1
+        try:
+            if rng.random() < read_ratio:
+                if result["orders"] and rng.random() < 0.5:
+                    response = client.get(f"/orders/{rng.choice(result['orders'])['id']}")
+                elif rng.random() < 0.5:
+                    response = client.get("/products?format=json")
+                else:
+                    response = client.get(f"/customers/{rng.randint(1, customers)}")
+                if response.status_code >= 400:
+                    result["errors"][f"HTTP {response.status_code} on read"] += 1
+                else:
+                    result["reads"] += 1
+                continue
+
+            kind = rng.choices(["order", "retried order", "bulk prices", "product"], weights=[5, 2, 1, 1])[0]
+            if kind in ("order", "retried order"):
+                body = {"customer_id": rng.randint(1, customers),
+                        "items": [{"product_id": rng.randint(1, products), "quantity": rng.randint(1, 3)}
+                                  for _ in range(rng.randint(1, 3))]}
+                headers = {"Idempotency-Key": f"{worker_id}-{sequence}"} if kind == "retried order" else {}
+                response = client.post("/orders", json=body, headers=headers)
+                if response.status_code == 201 and kind == "retried order":
+                    # A client retry after a timeout must get the same order back
+                    retry = client.post("/orders", json=body, headers=headers)
+                    if retry.status_code != 201 or retry.json["id"] != response.json["id"]:
+                        result["idempotent_mismatches"] += 1
+                if response.status_code == 201:
+                    result["orders"].append({"id": response.json["id"], **body})
+            elif kind == "bulk prices":
+                ids = rng.sample(range(1, products + 1), min(20, products))
+                response = client.patch("/products/bulk", json={
+                    "products": [{"id": i, "price": round(rng.uniform(1, 100), 2)} for i in ids]})
+                if response.status_code == 200:
+                    result["product_writes"] += 1
+            else:
+                response = client.post("/products", json={"name": f"Stress {worker_id}-{sequence}",
+                                                           "price": rng.uniform(1, 100)})
+                if response.status_code == 201:
+                    result["product_writes"] += 1
+
+            if response.status_code >= 400:
+                result["errors"][f"HTTP {response.status_code} on {kind}"] += 1
+            else:
+                result["writes"][kind] += 1
+        except Exception as e:
+            result["errors"][type(e).__name__] += 1
+
+    result["lock_stats"] = lock_stats.snapshot()
+    return result
+
+def _process_worker(arguments):
+    from database import engine, lock_stats
+    # Don't reuse the parent's pooled connections in the child
+    engine.dispose(close=False)
+    lock_stats.reset()
+    app = sys.modules["app"].app
+    return _worker(app, *arguments)
+
+def _check_invariants(results, customers):
+    '''Returns a list of (description, passed, detail)'''
+    from sqlalchemy import select, func
+    from database import get_session
+    from objects import Order, OrderItem, CustomerSummary, CatalogVersion
+
+    acknowledged = [order for result in results for order in result["orders"]]
+    checks = []
+    with get_session(write=False) as session:
+        orphans = session.execute(
+            select(func.count()).select_from(OrderItem)
+            .where(OrderItem.order_id.not_in(select(Order.id)))
+        ).scalar()
+        checks.append(("no orphan order items", orphans == 0, f"{orphans} orphan(s)"))
+
+        stored = {}
+        for order_id, product_id, quantity in session.execute(
+                select(OrderItem.order_id, OrderItem.product_id, OrderItem.quantity)):
+            stored.setdefault(order_id, Counter())[product_id] += quantity
+        lost = 0
+        for order in acknowledged:
+            expected = Counter()
+            for item in order["items"]:
+                expected[item["product_id"]] += item["quantity"]
+            if stored.get(order["id"]) != expected:
+                lost += 1
+        checks.append(("every acknowledged order stored with its items", lost == 0,
+                       f"{lost} of {len(acknowledged)} missing or different"))
+
+        order_counts = dict(session.execute(
+            select(Order.customer_id, func.count()).group_by(Order.customer_id)).all())
+        summary_counts = dict(session.execute(
+            select(CustomerSummary.customer_id, CustomerSummary.order_count)).all())
+        drifted = sum(1 for customer_id in range(1, customers + 1)
+                      if order_counts.get(customer_id, 0) != summary_counts.get(customer_id, 0))
+        checks.append(("customer summaries match order counts (no lost updates)", drifted == 0,
+                       f"{drifted} customer(s) drifted"))
+
+        versions = session.execute(select(func.count()).select_from(CatalogVersion)).scalar()
+        product_writes = sum(result["product_writes"] for result in results)
+        checks.append(("one catalog version per product write", versions == product_writes,
+                       f"{versions} versions for {product_writes} writes"))
+
+    mismatches = sum(result["idempotent_mismatches"] for result in results)
+    checks.append(("idempotent retries return the original order", mismatches == 0, f"{mismatches} mismatch(es)"))
+
+    detached = sum(result["errors"]["DetachedInstanceError"] for result in results)
+    checks.append(("no detached instance errors", detached == 0, f"{detached} error(s)"))
+    return checks
+
+def run_once(args):
+    '''Runs the stress test for a single journal mode in this process, returns True if every check passed'''
+    with tempfile.TemporaryDirectory() as directory:
+        app, engine = _setup(os.path.join(directory, "stress.db"), args.journal_mode, args.customers, args.products)
+        worker_arguments = [(worker_id, args.duration, args.customers, args.products, args.read_ratio)
+                            for worker_id in range(args.workers)]
+
+        start = time.perf_counter()
+        if args.processes:
+            import multiprocessing
+            engine.dispose()
+            with multiprocessing.get_context("fork").Pool(args.workers) as pool:
+                results = pool.map(_process_worker, worker_arguments)
+            locks = Counter()
+            for result in results:
+                locks.update(result["lock_stats"])
+        else:
+            from concurrent.futures import ThreadPoolExecutor
+            from database import lock_stats
+            lock_stats.reset()
+            with ThreadPoolExecutor(args.workers) as executor:
+                results = list(executor.map(lambda arguments: _worker(app, *arguments), worker_arguments))
+            locks = lock_stats.snapshot()
+        elapsed = time.perf_counter() - start
+
+        checks = _check_invariants(results, args.customers)
+        engine.dispose()
+
+    writes = Counter()
+    errors = Counter()
+    for result in results:
+        writes.update(result["writes"])
+        errors.update(result["errors"])
+    reads = sum(result["reads"] for result in results)
+    commits = sum(writes.values())
+
+    print(f"journal_mode={args.journal_mode}, {args.workers} {'process' if args.processes else 'thread'} worker(s), {elapsed:.1f} s")
+    print(f"  writes:   {commits} ({commits / elapsed:,.1f} commits/s) {dict(writes)}")
+    print(f"  reads:    {reads} ({reads / elapsed:,.1f}/s)")
+    average_wait = locks["wait_seconds"] / locks["acquired"] * 1000 if locks["acquired"] else 0
+    print(f"  lock:     {locks['wait_seconds']:.2f} s waiting, {average_wait:.1f} ms per write session, "
+          f"{locks['retries']} retries, {locks['failures']} gave up")
+    print(f"  errors:   {dict(errors) if errors else 'none'}")
+    for description, passed, detail in checks:
+        print(f"  [{'PASS' if passed else 'FAIL'}] {description}" + ("" if passed else f": {detail}"))
+    return all(passed for _, passed, _ in checks)
+
+def run_stress(args):
+    if args.journal_mode != "both":
+        sys.exit(0 if run_once(args) else 1)
+
+    # The database URL is fixed at import, so each journal mode gets a fresh interpreter
+    failed = False
+    for journal_mode in JOURNAL_MODES:
+        command = [sys.executable, "-m", "ecommerce", "stress", "--journal-mode", journal_mode,
+                   "--workers", str(args.workers), "--duration", str(args.duration),
+                   "--customers", str(args.customers), "--products", str(args.products),
+                   "--read-ratio", str(args.read_ratio)]
+        if args.processes:
+            command.append("--processes")
+        failed |= subprocess.run(command, cwd=os.path.dirname(os.path.abspath(__file__))).returncode != 0
+    sys.exit(1 if failed else 0)